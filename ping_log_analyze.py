@@ -2,35 +2,353 @@
 # Python 3.6+ required!
 
 import argparse
+import hashlib
+import json
+import mmap
+import os
 import re
-from contextlib import suppress
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, suppress
+from itertools import compress, islice, repeat
+from operator import gt, ne, sub
 from pathlib import Path
 from datetime import datetime
-from statistics import median
+from functools import lru_cache, partial
+from math import modf
 
-# import os, psutil     # for performance measurements
+# import psutil     # for performance measurements
 
 
-REGEXP = r'^\d+ \w+ \w+ .*?(\d+\.\d+\.\d+\.\d+)\)?: icmp_seq=(\d+) ttl=\d+ time=([0-9.]+) .+$'
-REGEXP_TIMESTAMP = r'^\[([0-9]+\.[0-9]+)] \d+ \w+ \w+ .*?(\d+\.\d+\.\d+\.\d+)\)?: icmp_seq=(\d+) ttl=\d+ time=([0-9.]+) .+$'
+# Host name part is matched explicitly instead of with a lazy ".*?" and the line tail is not matched at all:
+# both only added backtracking work.
+REGEXP = rb'^[ \t]*\d+ \w+ \w+ (?:[^\s(]+ \()?(\d+\.\d+\.\d+\.\d+)\)?: icmp_seq=(\d+) ttl=\d+ time=([0-9.]+) '
+REGEXP_TIMESTAMP = rb'^[ \t]*\[([0-9]+\.[0-9]+)] \d+ \w+ \w+ (?:[^\s(]+ \()?(\d+\.\d+\.\d+\.\d+)\)?: icmp_seq=(\d+) ttl=\d+ time=([0-9.]+) '
 # LOG_PATTERN_DNS = re.compile(r'^\d+ \w+ \w+ (\d+\.\d+\.\d+\.\d+): icmp_seq=(\d+) ttl=\d+ time=([0-9.]+) .+$')
 # LOG_PATTERN_DNS_TIMESTAMP = re.compile(r'^\[([0-9]+\.[0-9]+)] \d+ \w+ \w+ (\d+\.\d+\.\d+\.\d+): icmp_seq=(\d+) ttl=\d+ time=([0-9.]+) .+$')
+LOG_MARKER = b'icmp_seq='
 DEFAULT_THRESHOLD = 1    # ms
+OUTPUT_BUFFER_SIZE = 1 << 20    # bytes
+READ_BLOCK_SIZE = 1 << 20    # bytes, for logs which can't be memory-mapped
+CACHE_SAMPLE_SIZE = 64 << 10    # bytes hashed from each end of the log to validate the parse cache
+CACHE_FORMAT_VERSION = 2
+PARALLEL_PARSE_MIN_SIZE = 32 << 20    # bytes, smaller logs are parsed faster than worker processes start
 
 
-class LogItem:
+class ParsedLog:
+    """PING log records stored column-wise: one array per field instead of one object per record."""
 
-    __slots__ = ['log_string', 'ip', 'number', 'time', 'timestamp']
+    __slots__ = ['timestamps', 'offsets', 'numbers', 'times']
 
-    def __init__(self, log_string, pattern, timestamp=True):
-        self.log_string = log_string.strip()
-        if not (log_item_match_object := pattern.match(self.log_string)):
-            raise ValueError('Non-log string')
+    def __init__(self, timestamp=True):
+        self.timestamps = array('d') if timestamp else None    # raw UNIX timestamps, formatted only for the report
+        self.offsets = array('Q')    # positions of records in the log, IPs are read from there only for the report
+        self.numbers = array('I')    # ICMP sequence numbers are unsigned and fit 4 bytes
+        self.times = array('d')
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def append(self, log_item_match_object):
+        # Groups are bytes slices of the mapped log: int() and float() parse them directly, without decoding to str.
         log_data = log_item_match_object.groups()
-        self.timestamp = datetime.fromtimestamp(float(log_data[0])) if timestamp else None
-        self.ip = log_data[1 if timestamp else 0]
-        self.number = int(log_data[2 if timestamp else 1])
-        self.time = float(log_data[3 if timestamp else 2])
+        timestamp = self.timestamps is not None
+        # All fields are converted before anything is appended: a malformed record is skipped as a whole,
+        # so the columns stay aligned.
+        try:
+            record_timestamp = float(log_data[0]) if timestamp else None
+            number = int(log_data[2 if timestamp else 1])
+            time = float(log_data[3 if timestamp else 2])
+        except ValueError:
+            return
+        if timestamp:
+            self.timestamps.append(record_timestamp)
+        self.offsets.append(log_item_match_object.start())
+        try:
+            self.numbers.append(number)
+        except OverflowError:    # a custom --regexp may capture any number as a sequence number
+            self.widen_numbers()
+            self.numbers.append(number)
+        self.times.append(time)
+
+    def columns(self):
+        return [self.offsets, self.numbers, self.times] + ([self.timestamps] if self.timestamps is not None else [])
+
+    def widen_numbers(self):
+        if self.numbers.typecode != 'q':
+            self.numbers = array('q', self.numbers)
+
+    def extend(self, other):
+        if self.numbers.typecode != other.numbers.typecode:
+            self.widen_numbers()
+            other.widen_numbers()
+        if self.timestamps is not None:
+            self.timestamps.extend(other.timestamps)
+        self.offsets.extend(other.offsets)
+        self.numbers.extend(other.numbers)
+        self.times.extend(other.times)
+
+    def read_ip(self, index, content, pattern):
+        log_data = pattern.match(content, self.offsets[index]).groups()
+        ip = log_data[0 if self.timestamps is None else 1]
+        # an optional group of a user regexp may not participate; report it as None, as str() of it did before
+        return ip.decode() if ip is not None else None
+
+    def format_record(self, index, content, pattern):
+        return (f'{format_timestamp(self.timestamps[index]) if self.timestamps is not None else None} '
+                f'from {self.read_ip(index, content, pattern)}: seq={self.numbers[index]} time={self.times[index]}')
+
+
+def find_anomalies(parsed_log, time_threshold):
+    """Locate records slower than the threshold and gaps in sequence numbers.
+
+    Returns the per-record "above threshold" mask, indices of records above the threshold,
+    indices of records ending a gap and the numbers of requests skipped in each gap.
+    Both scans run as C-level iterator pipelines over the columns, without a per-record Python loop.
+    """
+    records_count = len(parsed_log)
+    numbers = parsed_log.numbers
+    above_threshold_mask = bytes(map(gt, parsed_log.times, repeat(time_threshold)))
+    records_above_threshold = list(compress(range(records_count), above_threshold_mask))
+    chunks_with_skips = list(compress(range(1, records_count),
+                                      map(ne, map(sub, islice(numbers, 1, None), numbers), repeat(1))))
+    skip_counts = [numbers[x] - numbers[x - 1] - 1 for x in chunks_with_skips]
+    return above_threshold_mask, records_above_threshold, chunks_with_skips, skip_counts
+
+
+def describe(values):
+    """Average, median and maximum of a non-empty sequence, as shown in the report.
+
+    Values are sorted once and both median and maximum are taken from the sorted copy.
+    """
+    sorted_values = sorted(values)
+    values_count = len(sorted_values)
+    middle = values_count // 2
+    if values_count % 2:
+        median_value = sorted_values[middle]
+    else:
+        median_value = (sorted_values[middle - 1] + sorted_values[middle]) / 2
+    return round(sum(values) / values_count, 3), median_value, sorted_values[-1]
+
+
+@lru_cache(maxsize=1024)
+def format_minute(minute_start):
+    """Date, hours and minutes shared by all timestamps of a minute, or None if local time isn't minute-aligned."""
+    moment = datetime.fromtimestamp(minute_start)
+    return moment.strftime('%Y-%m-%d %H:%M:') if not moment.second else None
+
+
+def format_second(seconds):
+    return datetime.fromtimestamp(seconds).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def format_timestamp(timestamp):
+    """Same as str(datetime.fromtimestamp(timestamp)), but the date and time part is built once per minute.
+
+    PING sends one request per second by default, so nearly every record starts a new second:
+    only seconds and microseconds are formatted per record.
+    """
+    fraction, seconds = modf(timestamp)
+    microseconds = round(fraction * 1_000_000)
+    seconds = int(seconds)
+    if microseconds >= 1_000_000:
+        seconds += 1
+        microseconds -= 1_000_000
+    second_of_minute = seconds % 60
+    if (minute_prefix := format_minute(seconds - second_of_minute)) is not None:
+        prefix = f'{minute_prefix}{second_of_minute:02d}'
+    else:
+        prefix = format_second(seconds)
+    return f'{prefix}.{microseconds:06d}' if microseconds else prefix
+
+
+def report_lines(parsed_log, time_threshold, content, pattern):
+    """Yield the report line by line, so it can be streamed to the output file.
+
+    content and pattern are the mapped log and the pattern it was parsed with: reported records are re-read from there.
+    """
+    records_count = len(parsed_log)
+    parsed_log_times = parsed_log.times
+    above_threshold_mask, records_above_threshold, chunks_with_skips, skip_counts = \
+        find_anomalies(parsed_log, time_threshold)
+
+    yield f'Total records: {records_count}'
+    average, median_value, maximum = describe(parsed_log_times)
+    yield f'Average ping: {average}'
+    yield f'Median ping: {median_value}'
+    yield f'Maximum ping: {maximum}'
+    yield ''
+    yield f'Total times above {time_threshold} ms: {len(records_above_threshold)}'
+    if records_above_threshold:
+        average, median_value, _ = describe(array('d', compress(parsed_log_times, above_threshold_mask)))
+        yield f'Percentage of requests above {time_threshold} ms: {len(records_above_threshold) * 100 / records_count:.2f}'
+        yield f'Average ping above {time_threshold} ms: {average}'
+        yield f'Median ping above {time_threshold} ms: {median_value}'
+    yield ''
+    yield f'Skipped requests chunks count: {len(chunks_with_skips)}'
+    if chunks_with_skips:
+        average, median_value, maximum = describe(skip_counts)
+        yield f'Average skipped requests in one chunk: {average}'
+        yield f'Median skipped requests in one chunk: {median_value}'
+        yield f'Maximum skipped requests in one chunk: {maximum}'
+    yield ''
+    if records_above_threshold:
+        yield f'\n__Times above {time_threshold} ms:__\n'
+        for x in records_above_threshold:
+            yield parsed_log.format_record(x, content, pattern)
+        yield ''
+    if chunks_with_skips:
+        yield '\n__Skipped requests:__\n'
+        for chunk_end, skipped_count in zip(chunks_with_skips, skip_counts):
+            yield parsed_log.format_record(chunk_end - 1, content, pattern)
+            yield f'Skipped: {skipped_count}'
+            yield parsed_log.format_record(chunk_end, content, pattern)
+            yield ''
+
+
+def line_regexp(regexp):
+    """Adapt a user regexp written for a single stripped line to scanning the whole log at once.
+
+    The regexp is anchored at line starts past leading blanks, "^" and "\\A" match there,
+    "$" and "\\Z" match at line ends, before trailing blanks and "\\r".
+    """
+    line_end = r'(?=[ \t\r]*$)'
+    flags_end = re.match(r'(?:\(\?[aiLmsux]+\))*', regexp).end()    # global inline flags have to stay in front
+    result = []
+    escaped = False
+    class_members_start = None
+    for position, char in enumerate(regexp[flags_end:], flags_end):
+        if escaped:
+            escaped = False
+            if class_members_start is None and char in 'AZ':
+                result.pop()    # the backslash
+                char = '(?:)' if char == 'A' else line_end
+        elif char == '\\':
+            escaped = True
+        elif class_members_start is not None:
+            # "]" as the first member of the class (right after "[" or "[^") is a literal
+            if char == ']' and position != class_members_start:
+                class_members_start = None
+        elif char == '[':
+            class_members_start = position + 1 + (regexp[position + 1:position + 2] == '^')
+        elif char == '^':
+            char = '(?:)'
+        elif char == '$':
+            char = line_end
+        result.append(char)
+    if 'x' in regexp[:flags_end]:
+        result.append('\n')    # a trailing comment of a verbose regexp must not swallow the closing parenthesis
+    return f'{regexp[:flags_end]}^[ \\t]*(?:{"".join(result)})'
+
+
+@contextmanager
+def map_log(infile_object):
+    """Provide the log content as a buffer: memory-mapped if possible, otherwise read in big binary blocks.
+
+    Pipes and other special files can't be memory-mapped and neither can empty files.
+    """
+    with open(infile_object, 'rb', buffering=0) as infile:
+        try:
+            content = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            content = None
+        if content is None:
+            yield b''.join(iter(partial(infile.read, READ_BLOCK_SIZE), b''))
+        else:
+            with content:
+                yield content
+
+
+def split_log(content, start, parts_count):
+    """Split content from start to its end into up to parts_count ranges ending at line boundaries."""
+    step = max((len(content) - start) // parts_count, 1)
+    boundaries = [start]
+    for _ in range(parts_count - 1):
+        if (line_end := content.find(b'\n', boundaries[-1] + step)) == -1:
+            break
+        boundaries.append(line_end + 1)
+    boundaries.append(len(content))
+    return [(range_start, range_end) for range_start, range_end in zip(boundaries, boundaries[1:])
+            if range_start < range_end]
+
+
+def parse_content(content, pattern, timestamp, log_range):
+    parsed_log = ParsedLog(timestamp)
+    for match in pattern.finditer(content, *log_range):
+        parsed_log.append(match)
+    return parsed_log
+
+
+def parse_log_range(infile_object, pattern, timestamp, log_range):
+    """Parse records within a range of the log in a worker process, which maps the file on its own."""
+    with map_log(infile_object) as content:
+        return parse_content(content, pattern, timestamp, log_range)
+
+
+def parse_log(infile_object, content, pattern, timestamp=True, jobs=1):
+    """Scan the whole log in one pass instead of matching it line by line.
+
+    content is the log provided by map_log(): it is matched as bytes, so no text decoding
+    and no per-line string objects are involved.
+    Memory-mapped logs of PARALLEL_PARSE_MIN_SIZE and more are split at line boundaries
+    and parsed by up to jobs processes.
+    """
+    parsed_log = ParsedLog(timestamp)
+    scan_start = 0
+    if pattern.pattern in (REGEXP, REGEXP_TIMESTAMP):
+        # Cheap substring prefilter: skip files without PING records and the header before the first one.
+        # Only built-in patterns are known to require LOG_MARKER in every record.
+        if (first_marker := content.find(LOG_MARKER)) == -1:
+            return parsed_log
+        scan_start = content.rfind(b'\n', 0, first_marker) + 1
+    parallel = isinstance(content, mmap.mmap) and len(content) >= PARALLEL_PARSE_MIN_SIZE
+    log_ranges = split_log(content, scan_start, jobs if parallel else 1)
+    if not log_ranges:
+        return parsed_log
+    if len(log_ranges) == 1:
+        return parse_content(content, pattern, timestamp, log_ranges[0])
+    with ProcessPoolExecutor(len(log_ranges)) as executor:
+        for parsed_log_part in executor.map(parse_log_range, repeat(infile_object), repeat(pattern),
+                                            repeat(timestamp), log_ranges):
+            parsed_log.extend(parsed_log_part)
+    return parsed_log
+
+
+def parse_cache_key(infile_object, content, pattern, timestamp):
+    """Identify the log, parsing settings and cache data layout: size, modification time and a hash of both ends of the log."""
+    file_stat = infile_object.stat()
+    digest = hashlib.blake2b(content[:CACHE_SAMPLE_SIZE])
+    digest.update(content[-CACHE_SAMPLE_SIZE:])
+    digest.update(pattern.pattern)
+    # Columns are stored as raw native arrays: a cache written with another byte order or item sizes is stale too.
+    columns_layout = ' '.join(f'{column.typecode}{column.itemsize}'
+                              for column in [*ParsedLog(timestamp).columns(), array('q')])
+    digest.update(f'{pattern.flags} {timestamp} {CACHE_FORMAT_VERSION} {sys.byteorder} {columns_layout}'.encode())
+    return {'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns, 'digest': digest.hexdigest()}
+
+
+def load_parsed_log(cache_object, key, timestamp):
+    """Return the parsed log saved by save_parsed_log() for the same key, or None."""
+    with suppress(OSError, ValueError, EOFError, KeyError, TypeError), open(cache_object, 'rb') as cache:
+        header = json.loads(cache.readline())
+        if header['key'] == key:
+            parsed_log = ParsedLog(timestamp)
+            if header['numbers_typecode'] == 'q':
+                parsed_log.widen_numbers()
+            for column in parsed_log.columns():
+                column.fromfile(cache, header['records'])
+            return parsed_log
+    return None
+
+
+def save_parsed_log(cache_object, key, parsed_log):
+    """Store parsed columns next to the log as a JSON header line followed by raw array data."""
+    with suppress(OSError), open(cache_object, 'wb') as cache:
+        header = {'key': key, 'records': len(parsed_log), 'numbers_typecode': parsed_log.numbers.typecode}
+        cache.write(json.dumps(header).encode() + b'\n')
+        for column in parsed_log.columns():
+            column.tofile(cache)
 
 
 if __name__ == '__main__':
@@ -42,76 +360,47 @@ if __name__ == '__main__':
                              'as acceptable, values above are meant too high.',
                         default=DEFAULT_THRESHOLD)
     parser.add_argument('--timestamps', help='Whether there are timestamps in PING log.', action='store_true')
-    parser.add_argument('--regexp', metavar='"regular expression"', help='Regexp for locating suitable records in PING log.')
+    parser.add_argument('--regexp', metavar='"regular expression"',
+                        help='Regexp for locating suitable records in PING log. '
+                             'It is matched from the start of each line, with leading and trailing blanks stripped.')
+    parser.add_argument('-j', '--jobs', metavar='count', type=int,
+                        help='Number of processes parsing big logs in parallel. Defaults to the number of CPUs.',
+                        default=os.cpu_count() or 1)
+    parser.add_argument('--no-cache', help='Do not use or save the parsed log cache stored next to the log.',
+                        action='store_true')
     args = parser.parse_args()
 
     infile_object = Path(args.file_path)
     timestamp = args.timestamps
     if args.regexp:
-        pattern = re.compile(args.regexp)
+        pattern = re.compile(line_regexp(args.regexp).encode(), re.MULTILINE)
     else:
-        pattern = re.compile(REGEXP_TIMESTAMP if timestamp else REGEXP)
+        pattern = re.compile(REGEXP_TIMESTAMP if timestamp else REGEXP, re.MULTILINE)
     time_threshold = args.threshold
 
-    parsed_log = []
-    with open(infile_object) as infile:
-        for string in infile:
-            with suppress(ValueError):
-                parsed_log.append(LogItem(string, pattern, timestamp))
+    with map_log(infile_object) as content:
+        parsed_log = None
+        # Parse results are cached only for regular files: a pipe can't be read again to check the cache.
+        if use_cache := not args.no_cache and isinstance(content, mmap.mmap):
+            cache_object = Path(infile_object.parent / (infile_object.stem + '_parsed.cache'))
+            cache_key = parse_cache_key(infile_object, content, pattern, timestamp)
+            parsed_log = load_parsed_log(cache_object, cache_key, timestamp)
+        if parsed_log is None:
+            try:
+                parsed_log = parse_log(infile_object, content, pattern, timestamp, max(args.jobs, 1))
+            except OverflowError:
+                sys.exit(f'Sequence numbers in {infile_object} do not fit 64-bit integers.')
+            if use_cache:
+                save_parsed_log(cache_object, cache_key, parsed_log)
+        if parsed_log:
+            outfile_object = Path(infile_object.parent / (infile_object.stem + '_analyzed.txt'))
+            with open(outfile_object, 'w', buffering=OUTPUT_BUFFER_SIZE) as logfile:
+                for line_number, line in enumerate(report_lines(parsed_log, time_threshold, content, pattern)):
+                    if line_number:
+                        logfile.write('\n')
+                    logfile.write(line)
 
     if parsed_log:
-        records_above_threshold = []
-        chunks_with_skips = []
-        high_ping_counter = 0
-        skip_counts = []
-        previous_number = parsed_log[0].number - 1
-        previous_item = parsed_log[0]
-        for log_item in parsed_log:
-            if log_item.time > time_threshold:
-                records_above_threshold.append(log_item)
-                high_ping_counter += 1
-            if log_item.number != previous_number + 1:
-                skipped_count = log_item.number - previous_number - 1
-                chunks_with_skips.append({'start': previous_item, 'end': log_item, 'skipped': skipped_count})
-                skip_counts.append(skipped_count)
-            previous_item = log_item
-            previous_number = log_item.number
-
-        result = []
-        result.append(f'Total records: {len(parsed_log)}')
-        parsed_log_times = [x.time for x in parsed_log]
-        result.append(f'Average ping: {round(sum(parsed_log_times) / len(parsed_log), 3)}')
-        result.append(f'Median ping: {median(parsed_log_times)}')
-        result.append(f'Maximum ping: {max(parsed_log_times)}')
-        result.append('')
-        result.append(f'Total times above {time_threshold} ms: {len(records_above_threshold)}')
-        if records_above_threshold:
-            exceeding_times = [x.time for x in records_above_threshold]
-            result.append(f'Percentage of requests above {time_threshold} ms: {len(records_above_threshold) * 100 / len(parsed_log):.2f}')
-            result.append(f'Average ping above {time_threshold} ms: {round(sum(exceeding_times) / len(records_above_threshold), 3)}')
-            result.append(f'Median ping above {time_threshold} ms: {median(exceeding_times)}')
-        result.append('')
-        result.append(f'Skipped requests chunks count: {len(chunks_with_skips)}')
-        if chunks_with_skips:
-            result.append(f'Average skipped requests in one chunk: {round(sum(skip_counts) / len(skip_counts), 3)}')
-            result.append(f'Median skipped requests in one chunk: {median(skip_counts)}')
-            result.append(f'Maximum skipped requests in one chunk: {max(skip_counts)}')
-        result.append('')
-        if records_above_threshold:
-            result.append(f'\n__Times above {time_threshold} ms:__\n')
-            result.extend([f'{x.timestamp} from {x.ip}: seq={x.number} time={x.time}' for x in records_above_threshold])
-            result.append('')
-        if chunks_with_skips:
-            result.append('\n__Skipped requests:__\n')
-            for item in chunks_with_skips:
-                result.append(f'{item["start"].timestamp} from {item["start"].ip}: seq={item["start"].number} time={item["start"].time}')
-                result.append(f'Skipped: {item["skipped"]}')
-                result.append(f'{item["end"].timestamp} from {item["end"].ip}: seq={item["end"].number} time={item["end"].time}')
-                result.append('')
-
-        outfile_object = Path(infile_object.parent / (infile_object.stem + '_analyzed.txt'))
-        with open(outfile_object, 'w') as logfile:
-            logfile.write('\n'.join(result))
         print(f'Analyze results saved to {outfile_object}')
 
         ###
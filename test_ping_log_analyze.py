@@ -0,0 +1,90 @@
+import re
+import tempfile
+import unittest
+from pathlib import Path
+
+from ping_log_analyze import REGEXP, map_log, parse_log, line_regexp
+
+
+def ping_run(host, count, first_number=1):
+    return [f'64 bytes from {host}: icmp_seq={first_number + x} ttl=56 time=0.{x % 10 + 1} ms' for x in range(count)]
+
+
+class ParseLogTest(unittest.TestCase):
+
+    def parse(self, log_text, pattern=REGEXP):
+        with tempfile.TemporaryDirectory() as directory:
+            infile_object = Path(directory) / 'ping.log'
+            infile_object.write_bytes(log_text.encode())
+            with map_log(infile_object) as content:
+                return parse_log(infile_object, content, re.compile(pattern, re.MULTILINE), timestamp=False)
+
+    def test_mixed_host_shapes(self):
+        # Two PING runs appended to one log: one by IP, one by host name.
+        log_text = '\n'.join(['PING 192.168.1.1 (192.168.1.1) 56(84) bytes of data.', *ping_run('192.168.1.1', 3000),
+                              'PING example.com (93.184.216.34) 56(84) bytes of data.',
+                              *ping_run('example.com (93.184.216.34)', 3000)]) + '\n'
+        parsed_log = self.parse(log_text)
+        self.assertEqual(len(parsed_log), 6000)
+        self.assertEqual(list(parsed_log.numbers), [*range(1, 3001), *range(1, 3001)])
+
+    def test_malformed_record_skipped(self):
+        log_text = '\n'.join([*ping_run('192.168.1.1', 2), '64 bytes from 192.168.1.1: icmp_seq=3 ttl=56 time=1.2.3 ms',
+                              '64 bytes from 192.168.1.1: icmp_seq=4 ttl=56 time= ms',
+                              *ping_run('192.168.1.1', 2, first_number=5)]) + '\n'
+        parsed_log = self.parse(log_text)
+        self.assertEqual(list(parsed_log.numbers), [1, 2, 5, 6])
+        self.assertEqual([len(column) for column in parsed_log.columns()], [4, 4, 4])
+        parsed_log = self.parse(log_text, pattern=rb'^\d+ bytes from (\S+): icmp_seq=(\d+) ttl=\d+ time=([\d.]*) ')
+        self.assertEqual(list(parsed_log.numbers), [1, 2, 5, 6])
+        self.assertEqual([len(column) for column in parsed_log.columns()], [4, 4, 4])
+
+    def test_indented_records(self):
+        parsed_log = self.parse(''.join(f'  {line}\r\n' for line in ping_run('192.168.1.1', 3)))
+        self.assertEqual(list(parsed_log.numbers), [1, 2, 3])
+
+    def test_sequence_numbers_above_32_bits(self):
+        parsed_log = self.parse('\n'.join(ping_run('192.168.1.1', 3, first_number=2 ** 32 - 2)) + '\n')
+        self.assertEqual(list(parsed_log.numbers), [2 ** 32 - 2, 2 ** 32 - 1, 2 ** 32])
+        narrow_part = self.parse('\n'.join(ping_run('192.168.1.1', 2)) + '\n')
+        narrow_part.extend(parsed_log)
+        self.assertEqual(list(narrow_part.numbers), [1, 2, 2 ** 32 - 2, 2 ** 32 - 1, 2 ** 32])
+
+    def test_empty_log(self):
+        self.assertEqual(len(self.parse('')), 0)
+        self.assertEqual(len(self.parse('', pattern=rb'^(\S+) (\d+) (\S+)$')), 0)
+
+
+class LineRegexpTest(unittest.TestCase):
+
+    def find(self, regexp, log_text):
+        return re.findall(line_regexp(regexp).encode(), log_text, re.MULTILINE)
+
+    def test_anchored_at_line_start(self):
+        log_text = b'[1600000000.1] 64 bytes from 1.1.1.1: icmp_seq=1 ttl=5 time=1.2 ms\n'
+        self.assertEqual(self.find(r'\d+ bytes from (\S+): icmp_seq=(\d+)', log_text), [])
+        self.assertEqual(self.find(r'\[\S+] \d+ bytes from (\S+): icmp_seq=(\d+)', log_text), [(b'1.1.1.1', b'1')])
+
+    def test_surrounding_blanks_ignored(self):
+        log_text = b'  64 bytes: icmp_seq=1 time=1.2 ms \r\n\t64 bytes: icmp_seq=2 time=1.3 ms\n'
+        records = [(b'1', b'1.2'), (b'2', b'1.3')]
+        self.assertEqual(self.find(r'^64 bytes: icmp_seq=(\d+) time=(\S+) ms$', log_text), records)
+        self.assertEqual(self.find(r'\A64 bytes: icmp_seq=(\d+) time=(\S+) ms\Z', log_text), records)
+
+    def test_inline_flags_kept_in_front(self):
+        self.assertEqual(self.find(r'(?i)ICMP_SEQ=(\d+)$', b'icmp_seq=1\n'), [b'1'])
+        self.assertEqual(self.find('(?x) icmp_seq=(\\d+)  # sequence number', b'icmp_seq=1\n'), [b'1'])
+
+    def test_literal_dollar_kept(self):
+        self.assertEqual(self.find(r'cost \$(\d+)$', b'cost $5\n'), [b'5'])
+        self.assertEqual(self.find(r'cost [$](\d+)$', b'cost $5\n'), [b'5'])
+
+    def test_bracket_as_class_member(self):
+        self.assertEqual(self.find(r'([]$]+)$', b']$\r\n'), [b']$'])
+        self.assertEqual(self.find(r'([^]$\s]+)$', b'ab\r\n'), [b'ab'])
+        self.assertEqual(self.find(r'[[]x$', b'[x\r\n'), [b'[x'])
+        self.assertEqual(self.find(r'([\]$]+)$', b']$\r\n'), [b']$'])
+
+
+if __name__ == '__main__':
+    unittest.main()